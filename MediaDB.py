@@ -6,8 +6,26 @@
 import os
 import sys
 import json
+import csv
+import gzip
+import bz2
+import lzma
 import hashlib
+import math
+import zipfile
+import tarfile
+import zlib
+import contextlib
+import io
+from concurrent.futures import ThreadPoolExecutor
+import random
+import statistics
+import tempfile
 import datetime
+import time
+import threading
+import shutil
+import subprocess
 import re
 import exifread
 from inspect import currentframe, getframeinfo
@@ -44,33 +62,39 @@ Globals = {}
 # we will have to reconstruct the file if files move
 PicasaDB = {}
 
+# DestDB structure
+# Purpose - index of an already organized destination tree, kept between runs so
+#  files already in place are never hashed again (see IndexDestinationTree)
+#  'Root' = destination path, 'HashAlgorithm' = algorithm of the hashes below
+#  'Dirs' = { relative dir : { 'MTime', 'Files' : [names], 'Subdirs' : [names] } }
+#  'Files' = { relative path : [size, mtime, hash] }
+DestDB = {}
+
+# Resource governor
+# settings and token buckets used to throttle scans on shared storage (see InitGovernor)
+GovernorDB = {'Enabled': 0}
+_governorLock = threading.Lock()
+
 
 #---------------------
 # InitDB
 # call to initialize the library and the internal DB's
 #--------------------
-def InitDB(JsonInitFile ="", Debug = 0):
+def InitDB(JsonInitFile ="", Debug = 0, HashAlgorithm = "md5"):
     print("Initializing DB")
 
     Globals["VerboseLevel"] = Debug
+    if (HashAlgorithm not in HashStrategies):
+        ErrorPrint("Unknown hash algorithm: " + HashAlgorithm + ", using md5")
+        HashAlgorithm = "md5"
+    Globals["HashAlgorithm"] = HashAlgorithm
+    Globals["DatePolicy"] = "full"
     SortDB["RootNode"] = Node("top")
     if (JsonInitFile  is ""):
-        StatsDB["Ini count"] = 0   # .ini files, etc
-        StatsDB["Meta count"] = 0   # .moff,.thm files, etc
-        StatsDB["Picture count"] = 0     # any still or multi-still image
-        StatsDB["Video count"] = 0        # any video sequence
-        StatsDB["Raw count"] = 0           # any RAW image files
-        StatsDB["Reject count"] = 0      # when the Add fails, due to file not being image-type
-        StatsDB["Collision count"] = 0 # when files are duplicate
-        StatsDB["Total files"] = 0        # incremented for all files put into the DB
-        StatsDB["Error"] = 0                  # for easy lookup from stats DB
-        StatsDB["DateFromEXIF"] = 0 # debug - how many came from EXIF
-        StatsDB["DateFromStat"] = 0 # debug - how many came from Stat
-        StatsDB["DateFromDir"] = 0  # debug - how many came from Dir
-        StatsDB["DateFromFile"] = 0 # debug - how many came from File
-        PicasaDB["Contacts2"] = {} # list
-        PicasaDB["Picasa"] = {} # list
-        PicasaDB["Encoding"] = {} # list
+        initStats()
+    elif (isSnapshot(JsonInitFile)):
+        # written by OutputSnapshot, streamed straight into the DBs
+        savedAlgorithm = loadSnapshot(JsonInitFile)
     else:
         if JsonInitFile:
             with open(JsonInitFile, 'r') as f:
@@ -81,6 +105,16 @@ def InitDB(JsonInitFile ="", Debug = 0):
         NewDirDB.update(SuperStructure['NewDirDB'])
         MetaDB.update(SuperStructure['MetaDB'])
         NameToHashDB.update(SuperStructure['NameToHashDB'])
+        DestDB.update(SuperStructure.get('DestDB', {}))
+        # DBs written before the algorithm was recorded used md5
+        savedAlgorithm = SuperStructure.get('HashAlgorithm', "md5")
+    if (JsonInitFile  != ""):
+        # the fingerprints in a saved DB are only comparable with the algorithm
+        # that created them
+        if (savedAlgorithm != HashAlgorithm):
+            ErrorPrint("InitDB: " + JsonInitFile + " was hashed with " + savedAlgorithm +
+                       ", ignoring requested " + HashAlgorithm)
+        Globals["HashAlgorithm"] = savedAlgorithm
 
 #---------------------
 # CleanupDB
@@ -134,37 +168,65 @@ def AddFileToDB(file,  dir):
         else:
             hashname = NameToHashDB[file]
 
-        entry = DictDB.get(hashname, 0)
-        if (entry == 0):
-            DictDB[hashname] = {}
-            DictDB[hashname]['RefCount'] = 1
-            DictDB[hashname]['Name'] = file
-            DictDB[hashname]['Directory']= dir
-            DictDB[hashname]['FileType'] = ftype
-            DictDB[hashname]['DupeList'] = []
-            DictDB[hashname]['DupeList'].append(file)
-            # if this is the first time we see this file then treat as unique, otherwise, collision occurred
-            StatsDB["Total files"] = StatsDB["Total files"] + 1
-            UpdateStatsAdd(ftype)
-        else:
-            # this check - is it needed?
-            if (file == DictDB[hashname]['Name']):
-                return 1
-            count = DictDB[hashname].get('RefCount',  0)
-            if (count == 0):
-                frameinfo = getframeinfo(currentframe())
-                errorInfo = str(frameinfo.filename) + ":" + str(frameinfo.lineno) + "> "
-                ErrorPrint (errorInfo + "Error! zero refcount is unexpected")
-            DictDB[hashname]['RefCount'] = count + 1
-            DictDB[hashname]['DupeList'].append(file)
-            StatsDB["Collision count"] = StatsDB["Collision count"] + 1
-            orig = DictDB[hashname].get('Name', "(null)")
-            print("Collision: " + file + " with " + orig)
-            print("All collisions: " + str(DictDB[hashname]['DupeList']))
+        count = recordFile(hashname, file, dir, ftype)
     else:
         ErrorPrint("AddFileToDB: Skipping: " + file)
     return count
 
+#---------------------
+# AddArchivesToDB
+# call to add the pictures, raws and videos inside zip/tar archives (e.g. cloud
+# export bundles) without extracting them. each member becomes an ordinary DictDB
+# entry with the same hash a loose copy would get, so duplicates between archives
+# and the library are found. 'Archive' and 'Member' record where it lives, and
+# 'Directory' is the archive path plus the member's folder inside it.
+# archives are read in parallel, Workers at a time; each member is read once, for
+# both its hash and its dates, so the entries come back already analyzed.
+# results are merged in the order of 'archives', so when the same file is in two
+# of them, the first one listed is always the one kept as the original
+# Return count of members added or counted as duplicates
+#--------------------
+def AddArchivesToDB(archives, Workers = 4):
+    added = 0
+    with ThreadPoolExecutor(max_workers=Workers) as pool:
+        futures = [(archive, pool.submit(scanArchive, archive, Globals.get("HashAlgorithm", "md5")))
+                   for archive in archives]
+        for archive, future in futures:
+            records = future.result()
+            DebugPrint("Adding " + str(len(records)) + " members of <" + archive + "> to DB",  1)
+            for record in records:
+                added = added + addArchiveMember(archive, record)
+    return added
+
+#---------------------
+# OpenEntry
+# binary stream of the file behind a DictDB entry, loose or inside an archive
+#  with OpenEntry(entry) as f: ...
+# a tar member is reached through the data offset found by the scan, without
+# listing the archive: a plain tar seeks straight to it, a compressed one is
+# decompressed up to it once. seeking back in a compressed member starts over,
+# so read what is needed into memory first
+#--------------------
+@contextlib.contextmanager
+def OpenEntry(fileEntry):
+    if ('Archive' not in fileEntry):
+        with open(os.path.join(fileEntry['Directory'], fileEntry['Name']), 'rb') as f:
+            yield f
+    elif ('MemberOffset' in fileEntry):
+        with openArchive(fileEntry['Archive']) as archive:
+            info = tarfile.TarInfo(fileEntry['Member'])
+            info.offset_data = fileEntry['MemberOffset']
+            info.size = fileEntry['MemberSize']
+            with archive.extractfile(info) as f:
+                yield f
+    else:
+        with openArchive(fileEntry['Archive']) as archive:
+            with openMember(archive, fileEntry['Member']) as f:
+                yield f
+
+def IsArchiveFile(file):
+    return file.lower().endswith(ArchiveExtensions)
+
 #---------------------
 # CheckFileInDB
 # Return count of items with supplied name
@@ -279,6 +341,187 @@ def GetRecommendedTreeString():
     for pre,  fill,  nodule in RenderTree(SortDB["RootNode"]):
         string = string + "%s%s\n" % (pre,  nodule.name)
     return string
+
+#---------------------
+# IndexDestinationTree
+#
+# Bring DestDB up to date with an already organized destination tree.
+# a directory whose mtime has not changed has the same entries as last time, so
+# it is taken from DestDB without listing or stat'ing its files. in a new or changed
+# directory only files with a new size or mtime are hashed.
+# (a file rewritten in place, without any rename, is not noticed - nothing we do does that)
+#---------------------
+def IndexDestinationTree(destRoot):
+    DebugPrint("Index Destination Tree " + destRoot,  1)
+    algorithm = Globals.get("HashAlgorithm", "md5")
+    if (DestDB.get('Root', "") != destRoot or DestDB.get('HashAlgorithm', "") != algorithm):
+        DestDB.clear()
+        DestDB['Root'] = destRoot
+        DestDB['HashAlgorithm'] = algorithm
+        DestDB['Dirs'] = {}
+        DestDB['Files'] = {}
+    dirs = DestDB['Dirs']
+    files = DestDB['Files']
+    seenDirs = {}
+    seenFiles = {}
+    hashed = 0
+    pending = [""]
+    while (len(pending) > 0):
+        relDir = pending.pop()
+        fullDir = os.path.join(destRoot, relDir)
+        try:
+            dirMTime = os.stat(fullDir).st_mtime_ns
+        except OSError:
+            continue
+        seenDirs[relDir] = 1
+        cached = dirs.get(relDir, 0)
+        if (cached != 0 and cached['MTime'] == dirMTime):
+            for name in cached['Files']:
+                seenFiles[os.path.join(relDir, name)] = 1
+            pending.extend(os.path.join(relDir, name) for name in cached['Subdirs'])
+            continue
+        listing = {'MTime': dirMTime, 'Files': [], 'Subdirs': []}
+        try:
+            it = os.scandir(fullDir)
+        except OSError as e:
+            # keep what we knew about it (if anything), and try again next time
+            ErrorPrint("IndexDestinationTree: Skipping: " + fullDir + " : " + str(e))
+            if (cached != 0):
+                for name in cached['Files']:
+                    seenFiles[os.path.join(relDir, name)] = 1
+                pending.extend(os.path.join(relDir, name) for name in cached['Subdirs'])
+            continue
+        with it:
+            for dirEntry in it:
+                if (dirEntry.is_dir(follow_symlinks=False)):
+                    listing['Subdirs'].append(dirEntry.name)
+                    continue
+                if (IsImagingFile(dirEntry.name) not in ('p', 'r', 'v')):
+                    continue
+                relPath = os.path.join(relDir, dirEntry.name)
+                try:
+                    st = dirEntry.stat()
+                    known = files.get(relPath, 0)
+                    if (known == 0 or known[0] != st.st_size or known[1] != st.st_mtime_ns):
+                        files[relPath] = [st.st_size, st.st_mtime_ns, calcHash(dirEntry.path)]
+                        hashed = hashed + 1
+                except OSError as e:
+                    # the name is still taken, so the plan reports a conflict rather than
+                    # copying over it. size -1 makes the next index try it again
+                    ErrorPrint("IndexDestinationTree: Unreadable: " + dirEntry.path + " : " + str(e))
+                    files[relPath] = [-1, -1, ""]
+                listing['Files'].append(dirEntry.name)
+                seenFiles[relPath] = 1
+        dirs[relDir] = listing
+        pending.extend(os.path.join(relDir, name) for name in listing['Subdirs'])
+    # forget whatever disappeared since the last index
+    for relDir in [d for d in dirs if d not in seenDirs]:
+        del dirs[relDir]
+    for relPath in [f for f in files if f not in seenFiles]:
+        del files[relPath]
+    StatsDB["Dest files"] = len(files)
+    StatsDB["Dest hashed"] = hashed
+    DebugPrint("Indexed " + str(len(files)) + " files, hashed " + str(hashed),  1)
+
+#---------------------
+# CreateIncrementalPlan
+#
+# Compare the recommended tree (run CreateRecommendedTree first) against an already
+# organized destination and return only the operations needed to bring it up to date,
+# as a list of { 'Op', 'Hash', 'Source', 'Destination' }:
+#   'new'      - copy Source (original location) to Destination. when the file is
+#                inside an archive, 'Archive' and 'Member' say where
+#   'move'     - the file is already in the destination tree, at Source (relative)
+#   'conflict' - Destination is taken by a different file; 'Existing' has its hash
+# files already in place produce no operation, and are only counted.
+# the operations are meant to be done in order: the moves come first, each after
+# the move that empties its Destination, then the new files and conflicts
+#---------------------
+def CreateIncrementalPlan(destRoot):
+    DebugPrint("Create Incremental Plan",  1)
+    IndexDestinationTree(destRoot)
+    files = DestDB['Files']
+    locations = {}
+    for relPath, (size, mtime, hashname) in files.items():
+        locations.setdefault(hashname, []).append(relPath)
+    claimed = {} # destination : hash, for everything placed or planned so far
+    placed = 0
+    pending = [] # (hash, entry, destination) of everything not in place yet
+    for k, entry in DictDB.items():
+        newDirectory = entry.get('NewDirectory', 0)
+        if (newDirectory == 0):
+            continue
+        target = os.path.join(newDirectory, entry.get('Name', "(null)"))
+        current = files.get(target, 0)
+        if (current != 0 and current[2] == k):
+            claimed[target] = k
+            placed = placed + 1
+            continue
+        pending.append((k, entry, target))
+
+    # first the moves, as the slots they empty are free for the rest. a move that
+    # turns out blocked empties nothing, so repeat until no more moves get blocked
+    blocked = set()
+    resolved = None
+    while (resolved is None):
+        resolved = resolveMoves(pending, locations, files, claimed, blocked)
+    moves, claimed, vacated = resolved
+    plan = [{'Op': 'move', 'Hash': k, 'Source': locations[k][0], 'Destination': target} for k, target in moves]
+
+    moved = set(k for k, target in moves)
+    for k, entry, target in pending:
+        if (k in moved):
+            continue
+        current = files.get(target, 0)
+        owner = claimed.get(target, current[2] if (current != 0 and target not in vacated) else 0)
+        if (owner != 0):
+            plan.append({'Op': 'conflict', 'Hash': k, 'Existing': owner, 'Destination': target,
+                         'Source': os.path.join(entry.get('Directory', "(nulldir)"), entry.get('Name', "(null)"))})
+            continue
+        claimed[target] = k
+        plan.append({'Op': 'new', 'Hash': k, 'Destination': target,
+                     'Source': os.path.join(entry.get('Directory', "(nulldir)"), entry.get('Name', "(null)"))})
+        if ('Archive' in entry):
+            plan[-1]['Archive'] = entry['Archive'] # Source is Member inside Archive
+            plan[-1]['Member'] = entry['Member']
+    StatsDB["Plan placed"] = placed
+    StatsDB["Plan new"] = sum(1 for op in plan if op['Op'] == 'new')
+    StatsDB["Plan moved"] = sum(1 for op in plan if op['Op'] == 'move')
+    StatsDB["Plan conflicts"] = sum(1 for op in plan if op['Op'] == 'conflict')
+    return plan
+
+# the moves of CreateIncrementalPlan, for the files of 'pending' already somewhere in
+# the destination and not in 'blocked'. returns ([(hash, destination)] in an order
+# they can be done in, the claimed destinations, { emptied path : hash }), or None
+# after adding the moves that can not be done to 'blocked'
+def resolveMoves(pending, locations, files, claimed, blocked):
+    vacated = {locations[k][0]: k for k, entry, target in pending if k in locations and k not in blocked}
+    claims = dict(claimed)
+    moves = []
+    alreadyBlocked = len(blocked)
+    for k, entry, target in pending:
+        if (k not in locations or k in blocked):
+            continue
+        if (target in claims or (target in files and target not in vacated)):
+            blocked.add(k) # the destination keeps its file, or another one got it first
+            continue
+        claims[target] = k
+        moves.append((k, target))
+    if (len(blocked) > alreadyBlocked):
+        return None # those files stay where they are, so less is vacated: start over
+    # a move waits until the file at its destination has moved out
+    ordered = []
+    done = set()
+    waiting = moves
+    while (len(waiting) > 0):
+        ready = [(k, target) for k, target in waiting if target not in vacated or vacated[target] in done]
+        if (len(ready) == 0):
+            blocked.add(waiting[0][0]) # a cycle, e.g. two files trading names
+            return None
+        ordered.extend(ready)
+        done.update(k for k, target in ready)
+        waiting = [(k, target) for k, target in waiting if k not in done]
+    return ordered, claims, vacated
     
 # -----
 # DumpDB - useful for debug
@@ -326,6 +569,8 @@ def OutputJson(outputName):
     SuperStructure['NewDirDB'] = NewDirDB
     SuperStructure['MetaDB'] = MetaDB
     SuperStructure['NameToHashDB'] = NameToHashDB
+    SuperStructure['DestDB'] = DestDB
+    SuperStructure['HashAlgorithm'] = Globals.get("HashAlgorithm", "md5")
 
     jsonFile = open(outputName, "w")
     jstr = json.dumps(SuperStructure, sort_keys=True,
@@ -333,6 +578,136 @@ def OutputJson(outputName):
     jsonFile.write(jstr)
     jsonFile.close()
 
+# -----
+# OutputSnapshot
+# compact alternative to OutputJson for big DBs: gzip'ed JSON lines, a header line
+# then [table, { key : value }] lines of up to SnapshotBatch entries each, written as
+# the tables are walked, so nothing the size of the DB is built in memory.
+# the tables of SnapshotNested hold tables of their own (DestDB 'Files' and 'Dirs'):
+# their line has an empty {} in place of each, filled by [table, key, { ... }] batches
+# InitDB reads either format
+# -----
+SnapshotFormat = "MediaDB snapshot"
+SnapshotBatch = 1000
+SnapshotTables = {'DictDB': DictDB, 'StatsDB': StatsDB, 'PicasaDB': PicasaDB, 'NewDirDB': NewDirDB,
+                  'MetaDB': MetaDB, 'NameToHashDB': NameToHashDB, 'DestDB': DestDB}
+SnapshotNested = ('DestDB',)
+
+def OutputSnapshot(outputName):
+    encode = json.JSONEncoder(separators=(',', ':')).encode
+    # level 1: most of the size win of gzip at a fraction of the time
+    with gzip.open(outputName, "wt", encoding="utf-8", compresslevel=1) as f:
+        f.write(encode({'Format': SnapshotFormat, 'Version': 1,
+                        'HashAlgorithm': Globals.get("HashAlgorithm", "md5")}) + "\n")
+        for table, db in SnapshotTables.items():
+            if (table not in SnapshotNested):
+                writeSnapshotBatches(f, encode, [table], db)
+                continue
+            f.write(encode([table, {k: ({} if isinstance(v, dict) else v) for k, v in db.items()}]) + "\n")
+            for k, v in db.items():
+                if (isinstance(v, dict)):
+                    writeSnapshotBatches(f, encode, [table, k], v)
+
+def writeSnapshotBatches(f, encode, keys, db):
+    batch = {}
+    for k, v in db.items():
+        batch[k] = v
+        if (len(batch) >= SnapshotBatch):
+            f.write(encode(keys + [batch]) + "\n")
+            batch = {}
+    if (len(batch) > 0):
+        f.write(encode(keys + [batch]) + "\n")
+
+# -----
+# BenchmarkSnapshot
+# round trip the DB through OutputJson/InitDB and OutputSnapshot/InitDB, and report
+# write time, file size, load time and the peak RSS the load added. each load runs
+# in a fresh python process, so the peaks do not hide each other.
+# Entries > 0 benchmarks a synthetic DB of that many files instead of the current one
+# returns { 'json' / 'snapshot' : { 'Write s', 'Bytes', 'Load s', 'Load peak RSS MB' } }
+# -----
+def BenchmarkSnapshot(Entries = 0, Directory = None):
+    tempDir = tempfile.mkdtemp(dir=Directory)
+    saved = swapOutState() if (Entries > 0) else None
+    results = {}
+    try:
+        if (Entries > 0):
+            initStats()
+            fillSyntheticDB(Entries)
+        for kind, writer, name in [('json', OutputJson, "db.json"), ('snapshot', OutputSnapshot, "db.jsonl.gz")]:
+            path = os.path.join(tempDir, name)
+            start = time.perf_counter()
+            writer(path)
+            writeSeconds = time.perf_counter() - start
+            loadSeconds, peakBytes = measureLoad(path)
+            results[kind] = {'Write s': writeSeconds, 'Bytes': os.path.getsize(path),
+                             'Load s': loadSeconds, 'Load peak RSS MB': peakBytes / 1e6}
+            DebugPrint("%-8s write %8.2fs %12d bytes  load %8.2fs %10.1f MB peak RSS" %
+                       (kind, writeSeconds, results[kind]['Bytes'], loadSeconds, peakBytes / 1e6),  0)
+    finally:
+        if (saved is not None):
+            restoreState(saved)
+        shutil.rmtree(tempDir, ignore_errors=True)
+    return results
+
+# -----
+# IterManifest
+# generator of one manifest record per file in DictDB, nothing is built up in memory
+# -----
+ManifestFields = ['Hash', 'OriginalPath', 'Archive', 'NewDirectory', 'Date', 'DateSource', 'FileType', 'Duplicates']
+
+def IterManifest():
+    for k, entry in DictDB.items():
+        name = entry.get('Name', "(null)")
+        record = {'Hash': k,
+                  'OriginalPath': os.path.join(entry.get('Directory', "(nulldir)"), name),
+                  'Archive': entry.get('Archive', ""), # set when OriginalPath is inside this archive
+                  'NewDirectory': entry.get('NewDirectory', ""),
+                  'Date': "",
+                  'DateSource': "",
+                  'FileType': entry.get('FileType', ""),
+                  # full paths (archive + member inside archives); DBs from before kept bare names
+                  'Duplicates': [dupe for dupe in entry.get('DupeList', []) if dupe not in (name, entryLocation(entry))]}
+        if (entry.get('Analyzed', 0) == 1):
+            tSuccess,  tYear,  tMonth,  tDay, tCond = DetermineLikelyDate(entry, name)
+            if (tSuccess):
+                record['Date'] = "%04d-%02d-%02d" % (tYear, tMonth, tDay)
+                record['DateSource'] = tCond
+        yield record
+
+# -----
+# ExportManifest
+# write the manifest as JSONL (one object per line) or CSV, in a single pass.
+#  Format = "jsonl" or "csv", Compression = "", "gz", "bz2" or "xz"
+#  both are taken from the file name when not given, e.g. manifest.csv.gz
+# the file is flushed every FlushEvery records so a reader can follow it while it
+# is written (for gz this is a sync flush; bz2 and xz only become readable at the end)
+# returns the number of records written
+# -----
+def ExportManifest(outputName, Format = "", Compression = "", FlushEvery = 1000):
+    the_name, the_extension = os.path.splitext(outputName)
+    if (Compression == "" and the_extension.lower() in ('.gz', '.bz2', '.xz')):
+        Compression = the_extension.lower()[1:]
+        the_name, the_extension = os.path.splitext(the_name)
+    if (Format == ""):
+        Format = "csv" if (the_extension.lower() == '.csv') else "jsonl"
+    count = 0
+    with openCompressed(outputName, "w", Compression) as f:
+        if (Format == "csv"):
+            writer = csv.DictWriter(f, fieldnames=ManifestFields)
+            writer.writeheader()
+        for record in IterManifest():
+            if (Format == "csv"):
+                record['Duplicates'] = ";".join(record['Duplicates'])
+                writer.writerow(record)
+            else:
+                f.write(json.dumps(record) + "\n")
+            count = count + 1
+            if (count % FlushEvery == 0):
+                f.flush()
+    DebugPrint("ExportManifest: " + str(count) + " records to " + outputName,  1)
+    return count
+
 # -----
 # ReportStats - useful for debug
 # ------
@@ -341,6 +716,187 @@ def ReportStats():
     for k in StatsDB.keys():
         DebugPrint(" " + k + " : " + str(StatsDB[k]),  0)
 
+# -----
+# BenchmarkHashStrategies - throughput of each fingerprint strategy over a list of files
+#  returns { algorithm : { 'Seconds', 'Files/s', 'Read MB/s', 'Library MB/s' } }
+#  Read MB/s counts the bytes actually hashed, Library MB/s the full size of the files
+#  the strategies take turns for Repeats rounds, each round starting with the next one,
+#  and the median time is reported: only the first round can find the OS page cache
+#  cold, so no strategy is measured on cold reads alone
+# -----
+def BenchmarkHashStrategies(fileList, Algorithms = None, Repeats = 3):
+    if (Algorithms is None):
+        Algorithms = list(HashStrategies.keys())
+    sizes = [os.path.getsize(file) for file in fileList]
+    times = {algorithm: [] for algorithm in Algorithms}
+    for turn in range(Repeats):
+        first = turn % len(Algorithms)
+        for algorithm in Algorithms[first:] + Algorithms[:first]:
+            start = time.perf_counter()
+            for file in fileList:
+                calcHash(file, algorithm)
+            times[algorithm].append(time.perf_counter() - start)
+    results = {}
+    for algorithm in Algorithms:
+        strategy = HashStrategies[algorithm]
+        elapsed = max(statistics.median(times[algorithm]), 1e-9)
+        readBytes = sum(length for size in sizes for offset, length in hashSpans(size, strategy))
+        results[algorithm] = {'Seconds': elapsed,
+                              'Files/s': len(fileList) / elapsed,
+                              'Read MB/s': readBytes / elapsed / 1e6,
+                              'Library MB/s': sum(sizes) / elapsed / 1e6}
+        DebugPrint("%-16s %8.2fs %10.1f files/s %10.1f read MB/s %10.1f library MB/s" %
+                   (algorithm, elapsed, results[algorithm]['Files/s'],
+                    results[algorithm]['Read MB/s'], results[algorithm]['Library MB/s']),  0)
+    return results
+
+#---------------------
+# InitGovernor
+# call to run scans (AddFileToDB, UpdateDB) in low impact mode alongside other users
+# of the same storage:
+#  ReadBytesPerSec - token bucket limit on bytes read for hashing and EXIF
+#  OpensPerSec - token bucket limit on file opens
+#  LowPriority - lower the CPU (nice) and I/O (ionice) priority, where the OS allows.
+#                note this can not be undone for the life of the process
+#  LatencyFactor - back off when recent read latency exceeds the long term average by this factor
+# throughput and throttle state are kept up to date in StatsDB
+#--------------------
+def InitGovernor(ReadBytesPerSec = 20 * 1024 * 1024, OpensPerSec = 50, LowPriority = 1, LatencyFactor = 2.0):
+    with _governorLock:
+        GovernorDB.clear()
+        GovernorDB['ReadRate'] = ReadBytesPerSec
+        GovernorDB['OpenRate'] = OpensPerSec
+        GovernorDB['LatencyFactor'] = LatencyFactor
+        GovernorDB['ReadTokens'] = ReadBytesPerSec # allow a one second burst
+        GovernorDB['OpenTokens'] = OpensPerSec
+        GovernorDB['Scale'] = 1.0    # multiplier on both rates, lowered by backoff
+        GovernorDB['FastLatency'] = 0.0 # seconds per MB, short and long term averages
+        GovernorDB['SlowLatency'] = 0.0
+        GovernorDB['Start'] = time.monotonic()
+        GovernorDB['Refill'] = GovernorDB['Start']
+        GovernorDB['Enabled'] = 1
+        StatsDB["Governor state"] = "running"
+        StatsDB["Governor read bytes"] = 0
+        StatsDB["Governor opens"] = 0
+        StatsDB["Governor MB/s"] = 0.0
+        StatsDB["Governor sleep seconds"] = 0.0
+        StatsDB["Governor rate scale"] = 1.0
+    if (LowPriority):
+        lowerPriority()
+
+def DisableGovernor():
+    with _governorLock:
+        GovernorDB['Enabled'] = 0
+        StatsDB["Governor state"] = "off"
+
+
+#---------------------
+# PreviewLibrary
+# quick look at a library before committing to a full scan. only directory metadata
+# is walked for every file; hashing and analysis are done on random samples:
+#  - SampleSize files go through AddFileToDB/Analyze for date source coverage
+#  - duplicates can only have the same size, so files with a unique size are known
+#    to be unique. of the size groups with several files, random groups are hashed
+#    until SampleSize files are used, and their collisions scaled up to all groups.
+#    at most GroupSample files of one group are hashed (uncompressed RAWs can share
+#    one size by the thousand), a bigger group's collisions are estimated from those
+#  - groups are per size and file type, so the collisions of each type are scaled up
+#    on their own, and its count (unique files, as in StatsDB) is what remains
+# the real DB is left untouched. returns { name : [estimate, low, high] } with a
+# Confidence interval for each. the "Files seen: ..." counts of the walk, duplicates
+# included, and the Ini count are exact (low = high)
+#--------------------
+def PreviewLibrary(directories, SampleSize = 500, Confidence = 0.95, Seed = None, GroupSample = 20):
+    DebugPrint("Preview Library",  1)
+    rng = random.Random(Seed)
+    z = statistics.NormalDist().inv_cdf(0.5 + Confidence / 2)
+    typeCounts = {}
+    candidates = []   # (name, dir, size) of every picture, raw and video
+    sizeGroups = {}   # (size, type) : [index into candidates]
+    for theDir in directories:
+        pending = [theDir]
+        while (len(pending) > 0):
+            root = pending.pop()
+            try:
+                it = os.scandir(root)
+            except OSError:
+                continue
+            with it:
+                for dirEntry in it:
+                    if (dirEntry.is_dir(follow_symlinks=False)):
+                        pending.append(dirEntry.path)
+                        continue
+                    ftype = IsImagingFile(dirEntry.name)
+                    stat = Map_TypeToStat.get(ftype, "Error")
+                    typeCounts[stat] = typeCounts.get(stat, 0) + 1
+                    if (ftype in ('p', 'r', 'v')):
+                        size = dirEntry.stat().st_size
+                        sizeGroups.setdefault((size, ftype), []).append(len(candidates))
+                        candidates.append((dirEntry.name, root, size))
+    population = len(candidates)
+    result = {}
+    for stat in Map_TypeToStat.values():
+        result["Files seen: " + stat] = [typeCounts.get(stat, 0)] * 3
+    result["Ini count"] = [typeCounts.get(Map_TypeToStat['i'], 0)] * 3 # every one is counted
+
+    # duplicates: cluster sample of the size groups. a copy under another file type
+    # (same bytes, other extension) is not looked for
+    groups = [(ftype, members) for (size, ftype), members in sizeGroups.items() if len(members) > 1]
+    sizeGroups = None
+    rng.shuffle(groups)
+    collisions = []
+    typeCollisions = {'p': [], 'r': [], 'v': []}
+    hashed = 0
+    for ftype, members in groups:
+        if (hashed >= SampleSize and len(collisions) >= 2):
+            break
+        chosen = members if (len(members) <= GroupSample) else rng.sample(members, GroupSample)
+        hashes = {}
+        for index in chosen:
+            name, root, size = candidates[index]
+            try:
+                hashname = calcHash(os.path.join(root, name))
+            except OSError:
+                continue # unknown, rather than counted as a collision
+            hashes[hashname] = hashes.get(hashname, 0) + 1
+        hashed = hashed + len(chosen)
+        if (sum(hashes.values()) > 0):
+            collisions.append(groupCollisions(len(members), hashes))
+            typeCollisions[ftype].append(collisions[-1])
+    result["Collision count"] = estimateCollisions(collisions, [members for ftype, members in groups], z)
+    low, high = result["Collision count"][1], result["Collision count"][2]
+    result["Total files"] = [population - result["Collision count"][0], population - high, population - low]
+    for ftype, values in typeCollisions.items():
+        typeGroups = [members for t, members in groups if t == ftype]
+        estimate, low, high = estimateCollisions(values, typeGroups, z)
+        seen = typeCounts.get(Map_TypeToStat[ftype], 0)
+        result[Map_TypeToStat[ftype]] = [seen - estimate, seen - high, seen - low]
+
+    # dates: simple random sample through the normal add/analyze path
+    sample = rng.sample(candidates, min(SampleSize, population))
+    saved = swapOutState()
+    try:
+        initStats()
+        for name, root, size in sample:
+            try:
+                AddFileToDB(name, root)
+            except OSError:
+                continue
+        UpdateDB()
+        sources = {'exif': 0, 'file': 0, 'dir': 0, 'stat': 0, '': 0}
+        for k, entry in DictDB.items():
+            tSuccess,  tYear,  tMonth,  tDay, tCond = DetermineLikelyDate(entry, entry.get('Name', "(null)"))
+            sources[tCond if tSuccess else ''] = sources[tCond if tSuccess else ''] + 1
+        analyzed = len(DictDB)
+        for stat in ["DateFromEXIF", "DateFromFile", "DateFromDir", "DateFromStat"]:
+            result[stat] = scaleProportion(StatsDB[stat], analyzed, population, z)
+        for cond in ['exif', 'file', 'dir', 'stat']:
+            result["Date source " + cond] = scaleProportion(sources[cond], analyzed, population, z)
+    finally:
+        restoreState(saved)
+    for k in result.keys():
+        DebugPrint(" %s : %d (%d - %d)" % (k, result[k][0], result[k][1], result[k][2]),  0)
+    return result
 
 # --- private -------------------------------------------------
 
@@ -402,15 +958,80 @@ def Analyze(hashname,  fileEntry):
     DebugPrint("Analyzing " + theFile,  1)
     fileEntry['Analyzed'] = 1
     theDir = fileEntry.get('Directory',  "(nulldir)")
-    dateStat = FindDateFromStat(os.path.join(theDir, theFile)) # need full path, accessing file
-    dateDir = FindDateFromDirectory(theDir) # need just dir path
+    dateDir = policyDateDir(theDir) # need just dir path
     dateFile = FindDateFromFilename(justFileName) # need just the name
-    dateEXIF = FindDateFromEXIF(os.path.join(theDir, theFile)) # need full path, accessing file
-    DebugPrint("Analyzing: Stat:" + str(dateStat) + " DirName:" + str(dateDir) + " FileName:" + str(dateFile) + " EXIF:" + str(dateEXIF),  2)
-    fileEntry['DateStat'] = dateStat
+    resolveDates(fileEntry, dateDir, dateFile,
+                 lambda: FindDateFromStat(os.path.join(theDir, theFile)), # need full path, accessing file
+                 lambda: FindDateFromEXIF(os.path.join(theDir, theFile))) # need full path, accessing file
+    theParentDir = os.path.basename(theDir)
+    #print("Analyze: tag = " + theParentDir)
+    if ('Tag' not in fileEntry):
+        fileEntry['Tag'] = theParentDir
+
+# Date policies for Analyze, see SetDatePolicy
+#  None = evaluate every date source (the original behaviour)
+#  MinAgreement = the EXIF parse (a file open) is skipped when at least this many of the
+#                 cheap sources (file name, directory name) found the same date
+#  SkipStat = the stat is skipped when any other source found a date, as
+#             DetermineLikelyDate only falls back to it when all others fail
+#  FolderDate = the directory date also looks at the file's own folder name
+#               (e.g. photos/2019-04-05/), FindDateFromDirectory only sees its parent
+DatePolicies = {
+        'full' :  None,
+        'agree' : {'MinAgreement': 2, 'SkipStat': 1, 'FolderDate': 1}, # file name and directory agree
+        'cheap' : {'MinAgreement': 1, 'SkipStat': 1, 'FolderDate': 1}, # any date in the name is good enough
+    }
+
+def SetDatePolicy(policy):
+    if (policy not in DatePolicies):
+        ErrorPrint("Unknown date policy: " + policy + ", using full")
+        policy = "full"
+    Globals["DatePolicy"] = policy
+
+# is the cheap evidence (file name and directory dates) not good enough for the policy?
+def policyNeedsEXIF(dateDir, dateFile):
+    policy = DatePolicies[Globals.get("DatePolicy", "full")]
+    if (policy is None):
+        return 1
+    agreement = 0
+    cheap = [date for date in [dateFile, dateDir] if date[0] and isPlausibleDate(date[1], date[2], date[3])]
+    if (len(cheap) > 0):
+        agreement = sum(1 for date in cheap if date == cheap[0])
+    return agreement < policy['MinAgreement']
+
+# the directory date the current policy asks for
+def policyDateDir(theDir):
+    policy = DatePolicies[Globals.get("DatePolicy", "full")]
+    if (policy is not None and policy['FolderDate']):
+        date = regexFileDate1(os.path.basename(theDir))
+        if (date[0]):
+            return date
+    return FindDateFromDirectory(theDir)
+
+# evaluate the date sources cheapest first, the expensive ones only when the policy
+# says the cheap evidence is not good enough. dateDir and dateFile are already known,
+# statSource and exifSource are called only when needed.
+# sources that were not evaluated are left out of fileEntry and listed in 'SkippedSources'
+def resolveDates(fileEntry, dateDir, dateFile, statSource, exifSource):
+    policy = DatePolicies[Globals.get("DatePolicy", "full")]
+    skipped = []
+    if (policyNeedsEXIF(dateDir, dateFile)):
+        dateEXIF = exifSource()
+        fileEntry['DateEXIF'] = dateEXIF
+    else:
+        dateEXIF = [0, 0, 0, 0]
+        skipped.append('exif')
+    if (policy is None or not (policy['SkipStat'] and (dateEXIF[0] or dateFile[0] or dateDir[0]))):
+        dateStat = statSource()
+        fileEntry['DateStat'] = dateStat
+    else:
+        dateStat = [0, 0, 0, 0]
+        skipped.append('stat')
+    DebugPrint("Analyzing: Stat:" + str(dateStat) + " DirName:" + str(dateDir) + " FileName:" + str(dateFile) + " EXIF:" + str(dateEXIF) + " Skipped:" + str(skipped),  2)
     fileEntry['DateDir'] = dateDir
     fileEntry['DateFile'] = dateFile
-    fileEntry['DateEXIF'] = dateEXIF
+    if (len(skipped) > 0):
+        fileEntry['SkippedSources'] = skipped
     if (dateStat[0]):
         StatsDB['DateFromStat'] = StatsDB['DateFromStat'] + 1
     if (dateEXIF[0]):
@@ -419,23 +1040,38 @@ def Analyze(hashname,  fileEntry):
         StatsDB['DateFromDir'] = StatsDB['DateFromDir'] + 1
     if (dateFile[0]):
         StatsDB['DateFromFile'] = StatsDB['DateFromFile'] + 1
-    theParentDir = os.path.basename(theDir)
-    #print("Analyze: tag = " + theParentDir)
-    if ('Tag' not in fileEntry):
-        fileEntry['Tag'] = theParentDir
+    # the I/O saved: each skipped EXIF parse is a file open plus roughly the
+    # average number of bytes the EXIF parses so far have read
+    if ('exif' in skipped):
+        StatsDB['Skipped EXIF'] = StatsDB.get('Skipped EXIF', 0) + 1
+        if (StatsDB.get('EXIF reads', 0) > 0):
+            StatsDB['Skipped EXIF bytes (est)'] = StatsDB.get('Skipped EXIF bytes (est)', 0) + \
+                StatsDB['EXIF bytes read'] // StatsDB['EXIF reads']
+    if ('stat' in skipped):
+        StatsDB['Skipped Stat'] = StatsDB.get('Skipped Stat', 0) + 1
 
 #-- 
 # Find Date functions - each will return a standard  (success, YYYY,MM,DD)  array
 #--
 def FindDateFromEXIF(file):
+    GovernorOpen()
+    with open(file,  'rb') as f:
+        date, nbytes = exifDateFromStream(f, file)
+    StatsDB['EXIF reads'] = StatsDB.get('EXIF reads', 0) + 1
+    StatsDB['EXIF bytes read'] = StatsDB.get('EXIF bytes read', 0) + nbytes
+    return date
+
+# the EXIF date from any seekable binary stream (a file, or an archive member)
+# returns the date, and roughly how many bytes exifread got through
+def exifDateFromStream(f, file):
     success = 0
     year,  month,  day = 0,  0,  0
     # EXIF has two datetime fields, need to research...
     #tag = 'Image DateTime'
     tag = 'EXIF DateTimeOriginal'
 
-    f = open(file,  'rb')
     print("FindDateFromEXIF:" + file, end='')
+    start = time.monotonic()
     try:
         #tags = exifread.process_file(f, stop_tag='EXIF DateTimeOriginal', debug=True)
         tags = exifread.process_file(f, stop_tag='EXIF DateTimeOriginal')
@@ -448,7 +1084,8 @@ def FindDateFromEXIF(file):
     except IndexError:
         print("EXIF IndexError: " + file)
         tags = {}
-    f.close()
+    nbytes = f.tell()
+    GovernorRead(nbytes, time.monotonic() - start)
     value = tags.get(tag,  "unfound datetime")
     m = re.search('([0-9][0-9][0-9][0-9]):([0-9][0-9]):([0-9][0-9]) ([0-9][0-9]):([0-9][0-9]):([0-9][0-9])',  str(value))
     try:
@@ -463,7 +1100,7 @@ def FindDateFromEXIF(file):
         DebugPrint(errorInfo+"No EXIF tag in file:" + file, 3)
 
     print(".")
-    return [success,  year,  month,  day]
+    return [success,  year,  month,  day], nbytes
     
 def FindDateFromDirectory(file):
     #print("FindDateFromDir:" + file)
@@ -477,7 +1114,9 @@ def FindDateFromFilename(file):
 
 def FindDateFromStat(file):
     #print("FindDateFromStat:" + file)
-    mtime = os.path.getmtime(file)
+    return dateFromTimestamp(os.path.getmtime(file))
+
+def dateFromTimestamp(mtime):
     mod_timestamp = datetime.datetime.fromtimestamp(mtime)
     year = mod_timestamp.year
     month = mod_timestamp.month
@@ -492,6 +1131,9 @@ RegExPatterns = {
         ##  YY , MM, DD with where to find it. 
         ##     Example: 2013-4-17  (xxxx)-(x)-(xx) and 1, 2, 3
         ##     Example: 4-17-2013  (x)-(xx)-(xxxx) and 3, 1, 2
+        ## tried in order, so the phone/camera names go first
+        '(?:IMG|PXL|VID)_([12][09][0-9][0-9])([01][0-9])([0-3][0-9])' : [ 1,  2,  3],  # IMG_YYYYMMDD_hhmmss
+        '^([12][09][0-9][0-9])([01][0-9])([0-3][0-9])_' : [ 1,  2,  3],  # YYYYMMDD_hhmmss
         '([0-9][0-9]?)-([0-9][0-9]?)-([12][09][0-9][0-9])' : [ 3,  1,  2],  # MM-DD-YYYY
         '([0-9][0-9]?)_([0-9][0-9]?)_([12][09][0-9][0-9])' : [ 3,  1,  2],  # MM_DD_YYYY
         '^([0-9][0-9]?)([0-9][0-9]?)([12][09][0-9][0-9])' : [ 3,  1,  2],  # MM_DD_YYYY
@@ -500,6 +1142,13 @@ RegExPatterns = {
     }
 
 
+def isPlausibleDate(year, month, day):
+    try:
+        datetime.date(year, month, day)
+    except ValueError:
+        return 0
+    return year <= datetime.date.today().year + 1
+
 # original, simple method.  not used
 def regexFileDate(string):
     success = 0
@@ -528,6 +1177,10 @@ def regexFileDate1(string):
             year = int(m.group(indexYear))
             month = int(m.group(indexMonth))
             day = int(m.group(indexDay))
+            # digits that only look like a date, e.g. 20190405 read as MMDDYYYY = 1904-02-00
+            if (not isPlausibleDate(year, month, day)):
+                success,  year,  month,  day = 0,  0,  0,  0
+                continue
             success = 1
             break
         except AttributeError as e:
@@ -659,23 +1312,517 @@ def parseIni(filename, directory):
             except AttributeError as e:
                 pass
 
-def calcHash(file):
+# Fingerprint strategies for calcHash
+#  Digest = hashlib constructor
+#  Window = bytes read per window, into one reused buffer
+#  Sampled = 0: hash only the head window (the original method)
+#            1: hash head, middle and tail windows, so large videos from the same
+#               camera are not told apart only by their (identical) container headers
+# the algorithm is recorded in the saved DB, so fingerprints are never mixed
+HashStrategies = {
+        'md5' :             {'Digest': hashlib.md5, 'Window': 409600, 'Sampled': 0}, # original: 100 x 4KB
+        'blake2b' :         {'Digest': lambda: hashlib.blake2b(digest_size=16), 'Window': 409600, 'Sampled': 0},
+        'blake2s' :         {'Digest': lambda: hashlib.blake2s(digest_size=16), 'Window': 409600, 'Sampled': 0},
+        'blake2b-sampled' : {'Digest': lambda: hashlib.blake2b(digest_size=16), 'Window': 131072, 'Sampled': 1},
+        'md5-sampled' :     {'Digest': hashlib.md5, 'Window': 131072, 'Sampled': 1},
+    }
+
+# one read buffer per thread, grown as needed and reused for every file
+_hashBuffers = threading.local()
+
+def getHashBuffer(size):
+    buf = getattr(_hashBuffers, 'buf', None)
+    if (buf is None or len(buf) < size):
+        buf = bytearray(size)
+        _hashBuffers.buf = buf
+    return memoryview(buf)
+
+# list of (offset, length) windows of a file of 'size' bytes that get hashed
+def hashSpans(size, strategy):
+    window = strategy['Window']
+    if (strategy['Sampled'] == 0):
+        return [(0, min(size, window))]
+    if (size <= 3 * window):
+        return [(0, size)] # small enough to hash it all
+    return [(0, window), ((size - window) // 2, window), (size - window, window)]
+
+# 'head' is the first span when the caller already read it. f is then a stream
+# positioned right after it, that cannot seek, so gaps between spans are read through.
+# 'charge' = 0 when the reads are already charged to the governor underneath (GovernedFile)
+def hashStream(f, size, algorithm, head = None, charge = 1):
+    strategy = HashStrategies[algorithm]
+    hash_obj = strategy['Digest']()
+    view = getHashBuffer(strategy['Window'])
+    position = 0
+    spans = hashSpans(size, strategy)
+    if (head is not None):
+        hash_obj.update(head)
+        position = len(head)
+        spans = spans[1:]
+    for offset, length in spans:
+        if (offset != position and head is None):
+            f.seek(offset)
+        while (offset > position and head is not None):
+            start = time.monotonic()
+            n = f.readinto(view[:min(offset - position, len(view))])
+            if (not n):
+                break
+            if (charge):
+                GovernorRead(n, time.monotonic() - start)
+            position = position + n
+        remaining = length
+        while (remaining > 0):
+            start = time.monotonic()
+            n = f.readinto(view[:min(remaining, len(view))])
+            if (not n):
+                break
+            if (charge):
+                GovernorRead(n, time.monotonic() - start)
+            hash_obj.update(view[:n])
+            remaining = remaining - n
+        position = offset + length - remaining
+    #added uniqueness = add the file size to the hash
+    hash_obj.update(str(size).encode('utf-8'))
+    return hash_obj.hexdigest()
+
+def calcHash(file, algorithm = ""):
     #hashname = hashlib.md5(file.encode('utf-8')).hexdigest()
-    hash_md5 = hashlib.md5()
-    good_enough_number_of_chunks = 100 # how much to determine uniqueness?
-    chunk_count = good_enough_number_of_chunks
+    if (algorithm == ""):
+        algorithm = Globals.get("HashAlgorithm", "md5")
+    GovernorOpen()
     with open(file, 'rb') as f:
-        for chunk in iter(lambda: f.read(4096), b""):
-            hash_md5.update(chunk)
-            chunk_count = chunk_count - 1
-            if (chunk_count <= 0):
-                break
-    #added uniqueness = add the file size to the md5
-    chunk = str(os.stat(file).st_size).encode('utf-8')
-    hash_md5.update(chunk)
-    hashname = hash_md5.hexdigest()
+        size = os.fstat(f.fileno()).st_size
+        hashname = hashStream(f, size, algorithm)
     return hashname
 
+# estimate, low, high of a count in 'population' from 'hits' out of a simple random
+# sample of 'n'. the bounds can not go below the hits seen, or above what the misses leave
+def scaleProportion(hits, n, population, z):
+    if (n == 0):
+        return [0, 0, population]
+    low, high = wilsonInterval(hits, n, population, z)
+    return [round(hits / n * population), max(hits, round(low * population)),
+            min(population - (n - hits), round(high * population))]
+
+# Wilson score interval of a proportion, with the finite population correction
+# applied as a larger effective sample. unlike the normal approximation it does
+# not collapse to a single point when none or all of the sample are hits
+def wilsonInterval(hits, n, population, z):
+    p = hits / n
+    correction = (population - n) / (population - 1) if (population > 1) else 0
+    if (correction <= 0):
+        return p, p # the whole population was sampled
+    n = n / correction
+    center = (p + z * z / (2 * n)) / (1 + z * z / n)
+    margin = z * math.sqrt(p * (1 - p) / n + z * z / (4 * n * n)) / (1 + z * z / n)
+    return max(0.0, center - margin), min(1.0, center + margin)
+
+# collisions (files minus distinct contents) in a size group of 'members' files, from
+# 'hashes' = { hash : count } of k randomly chosen members. returns (estimate, variance).
+# exact when the whole group was hashed. otherwise the matching pairs among the k are
+# scaled up to all member pairs, which is unbiased for the number of duplicate pairs,
+# the same as the collisions when files have one copy each (the common case).
+# the variance treats the matched pairs as Poisson
+def groupCollisions(members, hashes):
+    k = sum(hashes.values())
+    if (k == members):
+        return float(sum(count - 1 for count in hashes.values())), 0.0
+    if (k < 2):
+        return 0.0, 0.0
+    pairs = sum(count * (count - 1) / 2 for count in hashes.values())
+    scale = (members * (members - 1)) / (k * (k - 1))
+    return pairs * scale, max(pairs, 1) * scale * scale
+
+# estimate, low, high of the total over 'clusters' clusters, from (value, variance)
+# of a simple random sample of them. the variances are those of values that were
+# themselves estimated from a subsample of their cluster (0 when exact)
+def scaleClusterSample(values, clusters, z):
+    n = len(values)
+    if (n == 0):
+        return [0, 0, 0]
+    estimates = [value for value, variance in values]
+    total = clusters * statistics.mean(estimates)
+    variance = clusters / n * sum(variance for value, variance in values)
+    if (n == clusters):
+        pass
+    elif (n < 2):
+        variance = variance + total * total
+    else:
+        variance = variance + clusters * clusters * (1 - n / clusters) * statistics.variance(estimates) / n
+    margin = z * math.sqrt(variance)
+    return [round(total), round(max(0, total - margin)), round(total + margin)]
+
+# estimate, low, high of the collisions in 'groups' (lists of same size files), from
+# the (value, variance) of the sampled ones. a group of n files has at most n - 1
+# collisions; when fewer than two of the groups were sampled, that is all that is known.
+# when none of the sampled groups had a collision, the share of groups that do is
+# bounded the way scaleProportion bounds a proportion with no hits
+def estimateCollisions(values, groups, z):
+    possible = sum(len(members) - 1 for members in groups)
+    estimate, low, high = scaleClusterSample(values, len(groups), z)
+    if (len(values) < min(2, len(groups))):
+        return [min(estimate, possible), 0, possible]
+    if (estimate == 0 and len(values) < len(groups)):
+        share = wilsonInterval(0, len(values), len(groups), z)[1]
+        return [0, 0, round(share * possible)]
+    return [min(estimate, possible), min(low, possible), min(high, possible)]
+
+# put a picture, raw or video into DictDB, or count it as a duplicate of the file
+# already there with the same hash. shared by loose files and archive members.
+# loose files are known by name; archive members pass their full 'location'
+# (archive + member), since an export bundle repeats the library's file names
+def recordFile(hashname, file, dir, ftype, location = None):
+    count = -1
+    entry = DictDB.get(hashname, 0)
+    if (entry == 0):
+        DictDB[hashname] = {}
+        DictDB[hashname]['RefCount'] = 1
+        DictDB[hashname]['Name'] = file
+        DictDB[hashname]['Directory']= dir
+        DictDB[hashname]['FileType'] = ftype
+        DictDB[hashname]['DupeList'] = []
+        DictDB[hashname]['DupeList'].append(os.path.join(dir, file) if location is None else location)
+        # if this is the first time we see this file then treat as unique, otherwise, collision occurred
+        StatsDB["Total files"] = StatsDB["Total files"] + 1
+        UpdateStatsAdd(ftype)
+    else:
+        # this check - is it needed?
+        if (location is None and file == DictDB[hashname]['Name']):
+            return 1
+        if (location is not None and location in (entryLocation(DictDB[hashname]), *DictDB[hashname]['DupeList'])):
+            return 1 # same archive added again
+        count = DictDB[hashname].get('RefCount',  0)
+        if (count == 0):
+            frameinfo = getframeinfo(currentframe())
+            errorInfo = str(frameinfo.filename) + ":" + str(frameinfo.lineno) + "> "
+            ErrorPrint (errorInfo + "Error! zero refcount is unexpected")
+        DictDB[hashname]['RefCount'] = count + 1
+        DictDB[hashname]['DupeList'].append(os.path.join(dir, file) if location is None else location)
+        StatsDB["Collision count"] = StatsDB["Collision count"] + 1
+        orig = DictDB[hashname].get('Name', "(null)")
+        print("Collision: " + file + " with " + orig)
+        print("All collisions: " + str(DictDB[hashname]['DupeList']))
+    return count
+
+ArchiveExtensions = ('.zip', '.tar', '.tgz', '.tar.gz', '.tbz2', '.tar.bz2', '.txz', '.tar.xz')
+
+# what a damaged or unsupported archive or member can raise. zipfile raises
+# NotImplementedError for e.g. Deflate64 members and RuntimeError for encrypted ones
+ArchiveErrors = (OSError, EOFError, RuntimeError, NotImplementedError, zipfile.BadZipFile,
+                 tarfile.TarError, zlib.error, lzma.LZMAError)
+
+def openArchive(archivePath, stream = False, fileobj = None):
+    if (archivePath.lower().endswith('.zip')):
+        return zipfile.ZipFile(archivePath if fileobj is None else fileobj)
+    if (stream):
+        # one forward pass, a compressed tar would decompress from the start on every backward seek
+        return tarfile.open(archivePath, 'r|*', fileobj=fileobj)
+    return tarfile.open(archivePath, 'r:*', fileobj=fileobj) # random access, to open a single member (see OpenEntry)
+
+def openMember(archive, member):
+    if (isinstance(archive, zipfile.ZipFile)):
+        return archive.open(member)
+    return archive.extractfile(member)
+
+# (name, size, mtime, info) of every regular file in an archive. pass info to
+# openMember, looking a name up would read a streamed tar to the end
+def iterArchiveMembers(archive):
+    if (isinstance(archive, zipfile.ZipFile)):
+        for info in archive.infolist():
+            if (not info.is_dir()):
+                yield info.filename, info.file_size, zipTimestamp(info), info
+    else:
+        for info in archive:
+            if (info.isfile()):
+                yield info.name, info.size, info.mtime, info
+
+# the archive file as scanArchive reads it. every read is charged to the governor,
+# so what tarfile and zipfile read on their own counts too: headers, and the rest of
+# each member that a streamed tar has to read through to get to the next one
+class GovernedFile(io.RawIOBase):
+    def __init__(self, f):
+        self.f = f
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return self.f.seekable()
+
+    def readinto(self, b):
+        start = time.monotonic()
+        n = self.f.readinto(b)
+        GovernorRead(n or 0, time.monotonic() - start)
+        return n
+
+    def seek(self, offset, whence = io.SEEK_SET):
+        return self.f.seek(offset, whence)
+
+    def tell(self):
+        return self.f.tell()
+
+# None when the entry has no valid date (zip tools write 0 for unknown)
+def zipTimestamp(info):
+    try:
+        return datetime.datetime(*info.date_time).timestamp()
+    except (ValueError, OverflowError, OSError):
+        return None
+
+# runs in a worker thread: hash and date every picture, raw and video of one archive.
+# nothing global is written here, the records are merged by addArchiveMember.
+# each member is read once, front to back: the first hash window is kept in memory
+# and the EXIF header is parsed from there.
+# a member that cannot be read is skipped; a damaged archive keeps what was read before it
+def scanArchive(archivePath, algorithm):
+    records = []
+    strategy = HashStrategies[algorithm]
+    GovernorOpen()
+    try:
+        with open(archivePath, 'rb') as raw, openArchive(archivePath, stream=True, fileobj=GovernedFile(raw)) as archive:
+            for member, size, mtime, info in iterArchiveMembers(archive):
+                file = os.path.basename(member)
+                ftype = IsImagingFile(file)
+                if (ftype not in ('p', 'r', 'v')):
+                    continue
+                memberDir = os.path.dirname(os.path.normpath(member)) # tar names may start with ./
+                dir = os.path.join(archivePath, memberDir) if memberDir else archivePath
+                record = {'Member': member, 'Name': file, 'Directory': dir, 'FileType': ftype,
+                          'DateDir': policyDateDir(dir), 'DateFile': FindDateFromFilename(file),
+                          'DateStat': [0, 0, 0, 0] if mtime is None else dateFromTimestamp(mtime),
+                          'DateEXIF': None, 'EXIFBytes': 0, 'Size': size}
+                if (isinstance(info, tarfile.TarInfo)):
+                    record['Offset'] = info.offset_data # in the uncompressed stream
+                try:
+                    with openMember(archive, info) as f:
+                        head = f.read(hashSpans(size, strategy)[0][1])
+                        record['Hash'] = hashStream(f, size, algorithm, head, charge=0)
+                except ArchiveErrors as e:
+                    ErrorPrint("scanArchive: Skipping: " + os.path.join(archivePath, member) + " : " + str(e))
+                    continue
+                if (policyNeedsEXIF(record['DateDir'], record['DateFile'])):
+                    record['DateEXIF'], record['EXIFBytes'] = exifDateFromStream(io.BytesIO(head), os.path.join(archivePath, member))
+                records.append(record)
+    except ArchiveErrors as e:
+        ErrorPrint("scanArchive: Stopped reading: " + archivePath + " : " + str(e))
+    return records
+
+# where the file behind a DictDB entry lives: its path, or archive + member
+def entryLocation(fileEntry):
+    if ('Archive' in fileEntry):
+        return os.path.join(fileEntry['Archive'], fileEntry['Member'])
+    return os.path.join(fileEntry.get('Directory', "(nulldir)"), fileEntry.get('Name', "(null)"))
+
+# Return 1 if the member was added or counted as a duplicate, 0 if it was already known
+def addArchiveMember(archivePath, record):
+    file = record['Name']
+    hashname = record['Hash']
+    location = os.path.join(archivePath, record['Member'])
+    NameToHashDB[location] = hashname
+    refCount = DictDB.get(hashname, {}).get('RefCount', 0)
+    recordFile(hashname, file, record['Directory'], record['FileType'], location)
+    if (DictDB[hashname]['RefCount'] == refCount):
+        return 0
+    if (refCount > 0):
+        return 1
+    fileEntry = DictDB[hashname]
+    fileEntry['Archive'] = archivePath
+    fileEntry['Member'] = record['Member']
+    if ('Offset' in record):
+        fileEntry['MemberOffset'] = record['Offset']
+        fileEntry['MemberSize'] = record['Size']
+    fileEntry['Analyzed'] = 1
+    if (record['DateEXIF'] is not None):
+        StatsDB['EXIF reads'] = StatsDB.get('EXIF reads', 0) + 1
+        StatsDB['EXIF bytes read'] = StatsDB.get('EXIF bytes read', 0) + record['EXIFBytes']
+    resolveDates(fileEntry, record['DateDir'], record['DateFile'],
+                 lambda: record['DateStat'], lambda: record['DateEXIF'])
+    fileEntry['Tag'] = os.path.basename(record['Directory'])
+    return 1
+
+# clear the DBs for a side computation, restoreState puts them back
+def swapOutState():
+    saved = {}
+    for name, db in [('DictDB', DictDB), ('MetaDB', MetaDB), ('NameToHashDB', NameToHashDB),
+                     ('SortDB', SortDB), ('NewDirDB', NewDirDB), ('StatsDB', StatsDB), ('PicasaDB', PicasaDB),
+                     ('DestDB', DestDB)]:
+        saved[name] = (db, dict(db))
+        db.clear()
+    return saved
+
+def restoreState(saved):
+    for name, (db, contents) in saved.items():
+        db.clear()
+        db.update(contents)
+
+def isSnapshot(file):
+    with open(file, 'rb') as f:
+        return f.read(2) == b'\x1f\x8b' # gzip magic
+
+# read an OutputSnapshot file, one batch at a time straight into the DBs.
+# returns the hash algorithm it was written with
+def loadSnapshot(file):
+    decode = json.JSONDecoder().decode
+    with gzip.open(file, "rt", encoding="utf-8") as f:
+        header = decode(f.readline())
+        if (header.get('Format', "") != SnapshotFormat):
+            raise ValueError(file + " is not a " + SnapshotFormat)
+        for line in f:
+            table, *keys, batch = decode(line)
+            db = SnapshotTables[table]
+            for k in keys:
+                db = db[k]
+            db.update(batch)
+    return header.get('HashAlgorithm', "md5")
+
+# an analyzed looking DB of 'entries' files, for BenchmarkSnapshot
+def fillSyntheticDB(entries):
+    for i in range(entries):
+        hashname = hashlib.md5(str(i).encode('utf-8')).hexdigest()
+        name = "IMG_%07d.jpg" % i
+        directory = "/photos/%04d/%02d-%02d" % (2000 + i % 20, 1 + i % 12, 1 + i % 28)
+        DictDB[hashname] = {'RefCount': 1, 'Name': name, 'FileType': 'p', 'DupeList': [os.path.join(directory, name)],
+                            'Directory': directory,
+                            'Analyzed': 1, 'DateStat': [1, 2020, 1, 1], 'DateDir': [0, 0, 0, 0],
+                            'DateFile': [0, 0, 0, 0], 'DateEXIF': [1, 2000 + i % 20, 1 + i % 12, 1 + i % 28],
+                            'Tag': "%02d-%02d" % (1 + i % 12, 1 + i % 28),
+                            'NewDirectory': "%04d/%02d/%02d" % (2000 + i % 20, 1 + i % 12, 1 + i % 28)}
+        NameToHashDB[name] = hashname
+        StatsDB["Total files"] = StatsDB["Total files"] + 1
+        StatsDB["Picture count"] = StatsDB["Picture count"] + 1
+
+# InitDB of 'file' in a fresh interpreter: (load seconds, peak RSS added by the load in bytes)
+# on linux the peak is VmHWM, since ru_maxrss carries over the parent's peak through exec
+def measureLoad(file):
+    script = (
+        "import sys, time, json, resource\n"
+        "def peak():\n"
+        "    try:\n"
+        "        for line in open('/proc/self/status'):\n"
+        "            if (line.startswith('VmHWM:')):\n"
+        "                return int(line.split()[1]) * 1024\n"
+        "    except OSError:\n"
+        "        pass\n"
+        "    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss # bytes on macOS\n"
+        "sys.path.insert(0, sys.argv[1])\n"
+        "import MediaDB\n"
+        "before = peak()\n"
+        "start = time.perf_counter()\n"
+        "MediaDB.InitDB(sys.argv[2])\n"
+        "seconds = time.perf_counter() - start\n"
+        "print(json.dumps([seconds, peak() - before]))\n")
+    output = subprocess.run([sys.executable, "-c", script, os.path.dirname(os.path.abspath(__file__)), file],
+                            capture_output=True, text=True, check=True).stdout
+    seconds, peak = json.loads(output.strip().splitlines()[-1])
+    return seconds, peak
+
+# text mode open of a plain or compressed file, "w" or "r"
+def openCompressed(name, mode, compression):
+    if (compression == "gz"):
+        return gzip.open(name, mode + "t", encoding="utf-8", newline="")
+    if (compression == "bz2"):
+        return bz2.open(name, mode + "t", encoding="utf-8", newline="")
+    if (compression == "xz"):
+        return lzma.open(name, mode + "t", encoding="utf-8", newline="")
+    return open(name, mode, encoding="utf-8", newline="")
+
+# fresh counters for an empty DB
+def initStats():
+    StatsDB["Ini count"] = 0   # .ini files, etc
+    StatsDB["Meta count"] = 0   # .moff,.thm files, etc
+    StatsDB["Picture count"] = 0     # any still or multi-still image
+    StatsDB["Video count"] = 0        # any video sequence
+    StatsDB["Raw count"] = 0           # any RAW image files
+    StatsDB["Reject count"] = 0      # when the Add fails, due to file not being image-type
+    StatsDB["Collision count"] = 0 # when files are duplicate
+    StatsDB["Total files"] = 0        # incremented for all files put into the DB
+    StatsDB["Error"] = 0                  # for easy lookup from stats DB
+    StatsDB["DateFromEXIF"] = 0 # debug - how many came from EXIF
+    StatsDB["DateFromStat"] = 0 # debug - how many came from Stat
+    StatsDB["DateFromDir"] = 0  # debug - how many came from Dir
+    StatsDB["DateFromFile"] = 0 # debug - how many came from File
+    PicasaDB["Contacts2"] = {} # list
+    PicasaDB["Picasa"] = {} # list
+    PicasaDB["Encoding"] = {} # list
+
+# Resource governor hooks, no-ops unless InitGovernor was called
+
+def GovernorOpen():
+    if (GovernorDB['Enabled'] == 0):
+        return
+    with _governorLock:
+        StatsDB["Governor opens"] = StatsDB.get("Governor opens", 0) + 1
+        delay = governorWait('OpenTokens', 'OpenRate', 1)
+    # sleep outside the lock, so other threads can keep taking tokens meanwhile
+    if (delay > 0):
+        time.sleep(delay)
+
+def GovernorRead(nbytes, seconds):
+    if (GovernorDB['Enabled'] == 0 or nbytes <= 0):
+        return
+    with _governorLock:
+        # compare a fast and a slow moving average of the read latency. when the
+        # storage gets busy the fast one rises first: cut the rates, then creep back up
+        latency = seconds / (nbytes / 1e6)
+        if (GovernorDB['SlowLatency'] == 0.0):
+            GovernorDB['FastLatency'] = latency
+            GovernorDB['SlowLatency'] = latency
+        GovernorDB['FastLatency'] = 0.8 * GovernorDB['FastLatency'] + 0.2 * latency
+        GovernorDB['SlowLatency'] = 0.99 * GovernorDB['SlowLatency'] + 0.01 * latency
+        if (GovernorDB['FastLatency'] > GovernorDB['LatencyFactor'] * GovernorDB['SlowLatency']):
+            GovernorDB['Scale'] = max(0.05, GovernorDB['Scale'] * 0.7)
+        else:
+            GovernorDB['Scale'] = min(1.0, GovernorDB['Scale'] + 0.02)
+        StatsDB["Governor read bytes"] = StatsDB.get("Governor read bytes", 0) + nbytes
+        delay = governorWait('ReadTokens', 'ReadRate', nbytes)
+        elapsed = max(time.monotonic() - GovernorDB['Start'], 1e-9)
+        StatsDB["Governor MB/s"] = round(StatsDB["Governor read bytes"] / elapsed / 1e6, 2)
+        StatsDB["Governor rate scale"] = round(GovernorDB['Scale'], 2)
+        if (GovernorDB['Scale'] < 1.0):
+            StatsDB["Governor state"] = "backoff"
+        elif (delay > 0):
+            StatsDB["Governor state"] = "throttled"
+        else:
+            StatsDB["Governor state"] = "running"
+    if (delay > 0):
+        time.sleep(delay)
+
+# token bucket, caller holds _governorLock. the bucket may go into debt, in which
+# case the caller has to sleep until it is paid back. returns how many seconds, the
+# caller sleeps after releasing the lock (the debt already makes later callers wait longer)
+def governorWait(bucket, rateKey, amount):
+    rate = GovernorDB[rateKey] * GovernorDB['Scale']
+    if (rate <= 0):
+        return 0.0
+    now = time.monotonic()
+    elapsed = now - GovernorDB['Refill']
+    GovernorDB['Refill'] = now
+    for tokens, limit in [('ReadTokens', 'ReadRate'), ('OpenTokens', 'OpenRate')]:
+        GovernorDB[tokens] = min(GovernorDB[limit],
+                                 GovernorDB[tokens] + elapsed * GovernorDB[limit] * GovernorDB['Scale'])
+    GovernorDB[bucket] = GovernorDB[bucket] - amount
+    if (GovernorDB[bucket] >= 0):
+        return 0.0
+    delay = -GovernorDB[bucket] / rate
+    StatsDB["Governor sleep seconds"] = round(StatsDB.get("Governor sleep seconds", 0.0) + delay, 3)
+    return delay
+
+# nice works on any unix. ionice is linux only, best-effort class at its lowest level
+# (the idle class could starve the scan completely on a busy NAS)
+# niceness adds up and can not be raised again, so this only ever runs once per process
+def lowerPriority():
+    if (Globals.get("PriorityLowered", 0)):
+        return
+    Globals["PriorityLowered"] = 1
+    try:
+        os.nice(10)
+    except (AttributeError, OSError) as e:
+        DebugPrint("lowerPriority: nice not available: " + str(e),  1)
+    if (sys.platform.startswith('linux') and shutil.which('ionice') is not None):
+        try:
+            subprocess.run(['ionice', '-c', '2', '-n', '7', '-p', str(os.getpid())], check=True)
+        except (OSError, subprocess.CalledProcessError) as e:
+            DebugPrint("lowerPriority: ionice failed: " + str(e),  1)
+
 # a quick little function that cleans up the debug prints throughout the code
 # example: if verbose is at 3, it prints everything
 # if at v=1, then only general function flow is printed
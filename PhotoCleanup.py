@@ -16,11 +16,13 @@
 #-------------------
 import sys
 from PyQt5.QtWidgets import QApplication, QWidget, QFileDialog, QLabel, QPushButton
-from PyQt5.QtWidgets import QHBoxLayout, QVBoxLayout, QScrollArea
-from PyQt5.QtWidgets import QMainWindow, QAction
-from PyQt5.QtCore import Qt
+from PyQt5.QtWidgets import QHBoxLayout, QVBoxLayout, QScrollArea, QCheckBox
+from PyQt5.QtWidgets import QMainWindow, QAction, QListWidget, QListWidgetItem, QListView
+from PyQt5.QtCore import Qt, QTimer, QSize, QPoint
+from PyQt5.QtGui import QIcon
 import os
 import MediaDB
+import ThumbCache
 
 class MainWidget(QWidget):
     def __init__(self):
@@ -35,6 +37,7 @@ class MainWidget(QWidget):
         addButton = QPushButton("Add Directories...")
         self.directoriesFound = QLabel("0 directories")
         searchButton = QPushButton("Search Files")
+        previewButton = QPushButton("Preview")
         self.filesFound = QLabel("0 files")
         self.outputText = QLabel("")
         self.outputScroll = QScrollArea()
@@ -43,19 +46,32 @@ class MainWidget(QWidget):
         self.outputScroll.setWidget(self.outputText)
         self.selectedDirectories = QLabel("Click to remove search directories")
         analyzeButton = QPushButton("Analyze")
+        # throttle reads so a scan can share the storage with other users
+        self.lowImpactBox = QCheckBox("Low impact")
         self.resultsText = QLabel("")
         self.resultsScroll = QScrollArea()
         self.resultsScroll.setFixedHeight(400)
         self.resultsScroll.setWidgetResizable(True)
         self.resultsScroll.setWidget(self.resultsText)
+        # thumbnail previews of the proposed layout, filled in as the cache delivers them
+        self.previewList = QListWidget()
+        self.previewList.setViewMode(QListView.IconMode)
+        self.previewList.setResizeMode(QListView.Adjust)
+        self.previewList.setUniformItemSizes(True)
+        self.previewList.setIconSize(QSize(96, 96))
+        self.previewList.setFixedHeight(300)
+        self.previewTimer = QTimer(self)
+        self.previewTimer.setInterval(200)
 
         h_box = QHBoxLayout()
         h_box.addWidget(addButton)
         h_box.addWidget(self.directoriesFound)
         h_box.addStretch()
+        h_box.addWidget(previewButton)
         h_box.addWidget(searchButton)
         h_box.addWidget(self.filesFound)
         h_box.addWidget(analyzeButton)
+        h_box.addWidget(self.lowImpactBox)
         h_box.addStretch()
         v_box = QVBoxLayout()
         v_box.addLayout(h_box)
@@ -68,12 +84,16 @@ class MainWidget(QWidget):
         h2_box.addStretch()
         v_box.addWidget(self.outputScroll)
         v_box.addWidget(self.resultsScroll)
+        v_box.addWidget(self.previewList)
         v_box.addStretch()
         self.setLayout(v_box)
         
         addButton.clicked.connect(self.addButtonClicked)
         searchButton.clicked.connect(self.searchButtonClicked)
+        previewButton.clicked.connect(self.previewButtonClicked)
         analyzeButton.clicked.connect(self.analyzeButtonClicked)
+        self.lowImpactBox.toggled.connect(self.lowImpactToggled)
+        self.previewTimer.timeout.connect(self.updatePreviews)
 
         self.show()
 
@@ -103,14 +123,35 @@ class MainWidget(QWidget):
         self.directoriesFound.setText(str(len(self.DictSearchDirectories)) + " directories")
         self.outputText.setText("")
 
+    def lowImpactToggled(self, checked):
+        if (checked):
+            MediaDB.InitGovernor()
+        else:
+            MediaDB.DisableGovernor()
+
+    # sampled estimate of what a full search + analyze would find
+    def previewButtonClicked(self):
+        result = MediaDB.PreviewLibrary(list(self.DictSearchDirectories.keys()))
+        outstring = "Preview estimates (95% interval):\n"
+        for k, (estimate, low, high) in result.items():
+            outstring = outstring + "%s: %d (%d - %d)\n" % (k, estimate, low, high)
+        self.outputText.setText(outstring)
+
     def searchButtonClicked(self):
         self.FileCounter = 0
+        archives = []
         for theDir in self.DictSearchDirectories.keys():
             for root, directories, files in os.walk(theDir):
                 for filename in files:
-                    MediaDB.AddFileToDB(filename, root)
+                    if (MediaDB.IsArchiveFile(filename)):
+                        archives.append(os.path.join(root, filename))
+                    else:
+                        MediaDB.AddFileToDB(filename, root)
             self.FileCounter += MediaDB.StatsDB["Total files"];
             self.filesFound.setText(str(self.FileCounter) + " files")
+        # archives last, read in parallel
+        MediaDB.AddArchivesToDB(archives)
+        self.FileCounter = MediaDB.StatsDB["Total files"]
         self.filesFound.setText(str(self.FileCounter) + " files")
 
     def analyzeButtonClicked(self):
@@ -121,6 +162,39 @@ class MainWidget(QWidget):
         MediaDB.UpdateDB()
         MediaDB.CreateRecommendedTree()
         self.resultsText.setText(MediaDB.GetRecommendedTreeString())
+        self.fillPreviews()
+
+    def fillPreviews(self):
+        self.previewList.clear()
+        for k, entry in MediaDB.DictDB.items():
+            if (entry.get('Analyzed', 0) != 1):
+                continue
+            item = QListWidgetItem(os.path.join(entry.get('NewDirectory', ""), entry.get('Name', "(null)")))
+            item.setData(Qt.UserRole, k)
+            self.previewList.addItem(item)
+        self.previewTimer.start()
+
+    # only the items on screen ask for thumbnails, so scrolling through a huge
+    # library never queues more work than one screenful at a time
+    def updatePreviews(self):
+        if (self.previewList.count() == 0):
+            return
+        viewport = self.previewList.viewport()
+        first = self.previewList.indexAt(QPoint(1, 1)).row()
+        last = self.previewList.indexAt(QPoint(viewport.width() - 2, viewport.height() - 2)).row()
+        if (first < 0):
+            first = 0
+        if (last < 0):
+            last = min(self.previewList.count() - 1, first + 200)
+        for row in range(first, last + 1):
+            item = self.previewList.item(row)
+            if (item is None or item.data(Qt.UserRole + 1)):
+                continue
+            hashname = item.data(Qt.UserRole)
+            path = ThumbCache.Request(hashname, MediaDB.DictDB[hashname])
+            if (path is not None):
+                item.setIcon(QIcon(path))
+                item.setData(Qt.UserRole + 1, True)
 
     def saveFileDialog(self):
         options = QFileDialog.Options()
@@ -177,6 +251,9 @@ if __name__ == '__main__':
     if (len(sys.argv) == 3):
         os.chdir(sys.argv[2])
     MediaDB.InitDB("", 4) # -- initialize the MediaDB
+    ThumbCache.InitCache(os.path.join(os.path.expanduser("~"), ".cache", "photo-cleanup", "thumbs"))
     mainwindow = PhotoCleanupApp()
     #MediaDB.CleanupDB() # -- cleanup the MediaDB - in case we later support restarting the context
-    sys.exit(app.exec_())
+    result = app.exec_()
+    ThumbCache.CleanupCache()
+    sys.exit(result)
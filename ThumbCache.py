@@ -0,0 +1,234 @@
+#
+# Thumbnail Cache (ThumbCache)
+#
+# Content addressed, on-disk cache of preview thumbnails for the results view.
+#  key = the DictDB hash, so the same picture is only ever decoded once, wherever it lives
+#  thumbnails are built by a background worker pool, cheapest source first:
+#    1. the embedded EXIF thumbnail
+#    2. a .thm sidecar found through MetaDB (most cameras write one next to each video)
+#    3. a full decode and scale of the image (pictures only, never videos or raws)
+#  the cache is bounded, the least recently used thumbnails are evicted first
+#
+
+import os
+import io
+import threading
+import exifread
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from PyQt5.QtCore import Qt
+from PyQt5.QtGui import QImage
+import MediaDB
+
+# CacheDB - settings and running totals of the cache
+CacheDB = {}
+
+# LruDB structure
+#  key = hash, value = size of the thumbnail on disk
+#  ordered oldest access first, so eviction pops from the front
+LruDB = OrderedDict()
+
+# hashes being generated right now (hash : future), and hashes that have no
+# possible thumbnail (hash : reason) so they are never attempted twice
+PendingDB = {}
+FailedDB = {}
+
+_lock = threading.Lock()
+
+# how much of an archive member that is not a picture is read, for its EXIF thumbnail
+EXIFHeadBytes = 1024 * 1024
+
+#---------------------
+# InitCache
+# call once before Request/Lookup. picks up thumbnails left by earlier runs
+#--------------------
+def InitCache(CacheDir, MaxBytes = 256 * 1024 * 1024, Workers = 4, ThumbSize = 160, MaxDecodeBytes = 64 * 1024 * 1024):
+    CacheDB['Dir'] = CacheDir
+    CacheDB['MaxBytes'] = MaxBytes
+    CacheDB['MaxDecodeBytes'] = MaxDecodeBytes
+    CacheDB['ThumbSize'] = ThumbSize
+    CacheDB['Bytes'] = 0
+    CacheDB['Hits'] = 0
+    CacheDB['Generated'] = 0
+    CacheDB['Evicted'] = 0
+    os.makedirs(CacheDir, exist_ok=True)
+
+    # rebuild the LRU order from disk. mtime is used as the access time, since
+    # atime is often disabled, and Lookup touches the file on every hit
+    existing = []
+    for root, directories, files in os.walk(CacheDir):
+        for name in files:
+            the_name, the_extension = os.path.splitext(name)
+            if (the_extension == '.jpg'):
+                st = os.stat(os.path.join(root, name))
+                existing.append((st.st_mtime, the_name, st.st_size))
+    existing.sort()
+    with _lock:
+        LruDB.clear()
+        for mtime, hashname, size in existing:
+            LruDB[hashname] = size
+            CacheDB['Bytes'] = CacheDB['Bytes'] + size
+        evict()
+    CacheDB['Pool'] = ThreadPoolExecutor(max_workers=Workers)
+    MediaDB.DebugPrint("ThumbCache: " + str(len(LruDB)) + " thumbnails in " + CacheDir,  1)
+
+#---------------------
+# CleanupCache
+# stop the workers, anything not yet started is dropped
+#--------------------
+def CleanupCache():
+    pool = CacheDB.pop('Pool', None)
+    if (pool is not None):
+        pool.shutdown(wait=False, cancel_futures=True)
+    with _lock:
+        PendingDB.clear()
+
+#---------------------
+# Lookup
+# Return the path of the cached thumbnail, or None if it is not (yet) cached
+#--------------------
+def Lookup(hashname):
+    with _lock:
+        if (hashname not in LruDB):
+            return None
+        LruDB.move_to_end(hashname)
+        CacheDB['Hits'] = CacheDB['Hits'] + 1
+    path = thumbPath(hashname)
+    try:
+        os.utime(path)
+    except OSError:
+        return None
+    return path
+
+#---------------------
+# Request
+# Return the thumbnail path if cached, otherwise queue it for the workers and return None.
+# call again later (the UI polls) to pick up the result.
+#--------------------
+def Request(hashname, fileEntry):
+    path = Lookup(hashname)
+    if (path is not None):
+        return path
+    with _lock:
+        if (hashname in PendingDB or hashname in FailedDB or 'Pool' not in CacheDB):
+            return None
+        # copy what the worker needs, the DB entries are not touched from other threads
+        location = {k: fileEntry[k] for k in ('Name', 'Directory', 'FileType', 'Archive', 'Member',
+                                              'MemberOffset', 'MemberSize') if k in fileEntry}
+        sidecars = []
+        if ('Archive' not in location):
+            sidecars = findSidecars(location.get('Directory', "(nulldir)"), location.get('Name', "(null)"))
+        PendingDB[hashname] = CacheDB['Pool'].submit(generate, hashname, location, sidecars)
+    return None
+
+# --- private -------------------------------------------------
+
+def thumbPath(hashname):
+    return os.path.join(CacheDB['Dir'], hashname[:2], hashname + '.jpg')
+
+# .thm sidecars sit next to the file they belong to, with the same base name
+def findSidecars(theDir, theFile):
+    the_name, the_extension = os.path.splitext(os.path.basename(theFile))
+    entry = MediaDB.MetaDB.get(the_name, {})
+    sidecars = []
+    for meta in entry.get('MetaList', []):
+        if (MediaDB.IsImagingFile(meta) == 'm' and meta.lower().endswith('.thm')):
+            sidecars.append(os.path.join(theDir, meta))
+    return sidecars
+
+def exifThumbnail(f):
+    try:
+        tags = exifread.process_file(f, details=False)
+    except (OSError, KeyError, MemoryError, TypeError, IndexError):
+        return None
+    return tags.get('JPEGThumbnail', None)
+
+def looseEXIFThumbnail(location):
+    try:
+        with open(os.path.join(location['Directory'], location['Name']), 'rb') as f:
+            return exifThumbnail(f)
+    except OSError:
+        return None
+
+# an archive member is read into memory once, for both the EXIF thumbnail and the
+# decode: reaching a member of a compressed tar means decompressing up to it.
+# pictures are read up to one byte past MaxDecodeBytes, the rest only for EXIF
+def readMember(location):
+    limit = CacheDB['MaxDecodeBytes'] if location.get('FileType') == 'p' else EXIFHeadBytes
+    with MediaDB.OpenEntry(location) as f:
+        return f.read(limit + 1)
+
+def sidecarThumbnail(sidecars):
+    for sidecar in sidecars:
+        try:
+            with open(sidecar, 'rb') as f:
+                return f.read()
+        except OSError:
+            continue
+    return None
+
+# the expensive path, a full decode. loose files go through QImage(path) so the
+# reader can reject a file from its header; an archive member bigger than
+# MaxDecodeBytes is not attempted
+def decodeImage(location, data):
+    if ('Archive' not in location):
+        return QImage(os.path.join(location['Directory'], location['Name']))
+    if (len(data) > CacheDB['MaxDecodeBytes']):
+        return QImage()
+    return QImage.fromData(data)
+
+# runs in a worker thread. QImage (unlike QPixmap) is safe to use off the GUI thread
+def generate(hashname, location, sidecars):
+    image = QImage()
+    try:
+        data = None
+        if ('Archive' in location):
+            data = readMember(location)
+            thumbnail = exifThumbnail(io.BytesIO(data))
+        else:
+            thumbnail = looseEXIFThumbnail(location)
+        if (thumbnail is None):
+            thumbnail = sidecarThumbnail(sidecars)
+        if (thumbnail is not None):
+            image = QImage.fromData(thumbnail)
+        if (image.isNull() and location.get('FileType') not in ('v', 'r')):
+            image = decodeImage(location, data)
+        if (image.isNull()):
+            with _lock:
+                FailedDB[hashname] = "no decodable image"
+            return None
+        size = CacheDB['ThumbSize']
+        if (image.width() > size or image.height() > size):
+            image = image.scaled(size, size, Qt.KeepAspectRatio, Qt.SmoothTransformation)
+        path = thumbPath(hashname)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp = path + ".tmp" + str(threading.get_ident())
+        if (not image.save(temp, 'JPG')):
+            with _lock:
+                FailedDB[hashname] = "could not write thumbnail"
+            return None
+        os.replace(temp, path)
+        with _lock:
+            CacheDB['Generated'] = CacheDB['Generated'] + 1
+            LruDB[hashname] = os.path.getsize(path)
+            CacheDB['Bytes'] = CacheDB['Bytes'] + LruDB[hashname]
+            evict()
+        return path
+    except MediaDB.ArchiveErrors + (KeyError,) as e: # KeyError: member no longer in its archive
+        with _lock:
+            FailedDB[hashname] = str(e)
+        return None
+    finally:
+        with _lock:
+            PendingDB.pop(hashname, None)
+
+# caller holds _lock
+def evict():
+    while (CacheDB['Bytes'] > CacheDB['MaxBytes'] and len(LruDB) > 1):
+        hashname, size = LruDB.popitem(last=False)
+        CacheDB['Bytes'] = CacheDB['Bytes'] - size
+        CacheDB['Evicted'] = CacheDB['Evicted'] + 1
+        try:
+            os.remove(thumbPath(hashname))
+        except OSError:
+            pass